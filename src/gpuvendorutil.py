@@ -1,5 +1,7 @@
 import subprocess
+import functools
 
+@functools.lru_cache(maxsize=1)
 def get_gpu_vendor():
     try:
         # Execute the lshw command to get hardware details
@@ -11,14 +11,55 @@ from archinstall.lib.general import SysCommand
 import os
 import shutil
 import gpuvendorutil
-import subprocess
 import zipfile
+import tarfile
+import re
+import io
+import urllib.request
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 SCRIPTDIR = os.path.dirname(os.path.realpath(__file__))
+SDDM_THEME_URL = 'https://gitlab.com/api/v4/projects/37107648/packages/generic/sddm-eucalyptus-drop/2.0.0/sddm-eucalyptus-drop-v2.0.0.zip'
+LIMINE_ENTRY = '''
+:Polaris Linux {variant}
+    PROTOCOL=linux
+    KERNEL_PATH=boot:///vmlinuz-{kernel}
+    MODULE_PATH=boot:///initramfs-{kernel}{variant}.img
+    CMDLINE={cmdline}
+'''
 if TYPE_CHECKING:
 	_: Any
 
+def link_or_copy(src: str, dst: str):
+	# a hardlink costs no data at all when both ends are on the same filesystem
+	try:
+		os.link(src, dst)
+	except OSError:
+		shutil.copyfile(src, dst)
+
+def write_file(path: str, payload: str, mode: int = 0o644):
+	fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+	try:
+		data = memoryview(payload.encode())
+		while data:
+			data = data[os.write(fd, data):]
+	finally:
+		os.close(fd)
+
 class InstallerHack(Installer):
+	def __init__(self, *args, **kwargs):
+		super().__init__(*args, **kwargs)
+		self._kernel_params_cache: dict[tuple, tuple[Any, list[str]]] = {}
+
+	def _get_kernel_params(self, root, *args, **kwargs) -> list[str]:
+		key = (id(root), args, tuple(sorted(kwargs.items())))
+		if key not in self._kernel_params_cache:
+			# keep root alive alongside its params, so its id can't be reused by another object
+			self._kernel_params_cache[key] = (root, super()._get_kernel_params(root, *args, **kwargs))
+		# callers append to the result, so never hand out the cached list itself
+		return list(self._kernel_params_cache[key][1])
+
 	def _add_limine_bootloader(
 		self,
 		boot_partition: disk.PartitionModification,
@@ -31,7 +72,8 @@ class InstallerHack(Installer):
 
 		info(f"Limine boot partition: {boot_partition.dev_path}")
 
-		limine_path = self.target / 'usr' / 'share' / 'limine'
+		target = str(self.target)
+		limine_path = os.path.join(target, 'usr', 'share', 'limine')
 		hook_command = None
 
 		if SysInfo.has_uefi():
@@ -43,11 +85,11 @@ class InstallerHack(Installer):
 			info(f"Limine EFI partition: {efi_partition.dev_path}")
 
 			try:
-				efi_dir_path = self.target / efi_partition.mountpoint.relative_to('/') / 'EFI' / 'BOOT'
-				efi_dir_path.mkdir(parents=True, exist_ok=True)
+				efi_dir_path = os.path.join(target, str(efi_partition.mountpoint.relative_to('/')), 'EFI', 'BOOT')
+				os.makedirs(efi_dir_path, exist_ok=True)
 
-				for file in ('BOOTIA32.EFI', 'BOOTX64.EFI'):
-					shutil.copy(limine_path / file, efi_dir_path)
+				with ThreadPoolExecutor(max_workers=2) as pool:
+					list(pool.map(lambda file: shutil.copyfile(os.path.join(limine_path, file), os.path.join(efi_dir_path, file)), ('BOOTIA32.EFI', 'BOOTX64.EFI')))
 			except Exception as err:
 				raise exceptions.DiskError(f'Failed to install Limine in {self.target}{efi_partition.mountpoint}: {err}')
 
@@ -61,7 +103,7 @@ class InstallerHack(Installer):
 
 			try:
 				# The `limine-bios.sys` file contains stage 3 code.
-				shutil.copy(limine_path / 'limine-bios.sys', self.target / 'boot')
+				link_or_copy(os.path.join(limine_path, 'limine-bios.sys'), os.path.join(target, 'boot', 'limine-bios.sys'))
 
 				# `limine bios-install` deploys the stage 1 and 2 to the disk.
 				SysCommand(f'/usr/bin/arch-chroot {self.target} limine bios-install {parent_dev_path}', peek_output=True)
@@ -83,36 +125,28 @@ When = PostTransaction
 Exec = /bin/sh -c "{hook_command}"
 '''
 
-		hooks_dir = self.target / 'etc' / 'pacman.d' / 'hooks'
-		hooks_dir.mkdir(parents=True, exist_ok=True)
+		hooks_dir = os.path.join(target, 'etc', 'pacman.d', 'hooks')
+		os.makedirs(hooks_dir, exist_ok=True)
 
-		hook_path = hooks_dir / '99-limine.hook'
-		hook_path.write_text(hook_contents)
+		with open(os.path.join(hooks_dir, '99-limine.hook'), 'w') as file:
+			file.write(hook_contents)
 
 		kernel_params_orig = self._get_kernel_params(root)
 		kernel_params_orig.append("quiet")
 		kernel_params_orig.append("splash")
 		kernel_params = ' '.join(kernel_params_orig)
-		config_contents = 'TIMEOUT=5\n'
-
-		for kernel in self.kernels:
-			for variant in ('', 'fallback'):
-				entry = [
-					f'PROTOCOL=linux',
-					f'KERNEL_PATH=boot:///vmlinuz-{kernel}',
-					f'MODULE_PATH=boot:///initramfs-{kernel}{variant}.img',
-					f'CMDLINE={kernel_params}',
-				]
-
-				config_contents += f'\n:Polaris Linux {variant}\n'
-				config_contents += '\n'.join([f'    {it}' for it in entry]) + '\n'
+		config_contents = 'TIMEOUT=5\n' + ''.join(
+			LIMINE_ENTRY.format(kernel=kernel, variant=variant, cmdline=kernel_params)
+			for kernel in self.kernels
+			for variant in ('', 'fallback')
+		)
 
-		config_path = self.target / 'boot' / 'limine.cfg'
-		config_path.write_text(config_contents)
+		with open(os.path.join(target, 'boot', 'limine.cfg'), 'w') as file:
+			file.write(config_contents)
 
 		self.helper_flags['bootloader'] = "limine"
 
-packages = [
+packages = (
 	'wget',
 	'nano',
 	'openssh',
@@ -210,42 +244,71 @@ packages = [
 	'qt5-declarative',
 	'sddm',
 	'gspell'
-]
+)
 
-amd_drivers = [
+amd_drivers = (
     'vulkan-radeon',
 	'xf86-video-ati',
-	'mesa'
+	'mesa',
 	'libva-mesa-driver',
 	'xf86-video-amdgpu'
-]
+)
 
-nvidia_drivers = [
+nvidia_drivers = (
     'dkms',
     'nvidia-dkms',
 	'nvidia-utils'
-]
+)
 
-nvidia_newer_drivers = [
+nvidia_newer_drivers = (
 	'nvidia-open-dkms',
 	'nvidia-open',
 	'dkms',
 	'nvidia-utils'
-]
+)
 
-intel_drivers = [
+intel_drivers = (
     'mesa',
 	'intel-media-driver',
 	'libva-intel-driver',
 	'vulkan-intel'
-]
+)
 
-vmware_drivers = [
+vmware_drivers = (
 	'xf86-video-vmware',
 	'mesa',
 	'open-vm-tools'
-]
+)
+
+gpu_drivers = {
+	'amd': amd_drivers,
+	'intel': intel_drivers,
+	'nvidia_beforeturing': nvidia_drivers,
+	'nvidia_turingplus': nvidia_newer_drivers,
+	'vmware': vmware_drivers
+}
+
+# extra packages, several only available from polaris/chaotic-aur
+extra_packages = (
+	'zsh',
+	'polo',
+	'aic94xx-firmware',
+	'ast-firmware',
+	'wd719x-firmware',
+	'upd72020x-fw',
+	'xvkbd'
+)
 
+def download(url: str, retries: int = 5) -> io.BytesIO:
+	for attempt in range(retries):
+		try:
+			with urllib.request.urlopen(url, timeout=60) as response:
+				return io.BytesIO(response.read())
+		except OSError as err:
+			if attempt == retries - 1:
+				raise
+			warn(f"Download of {url} failed ({err}), retrying")
+			time.sleep(5)
 
 def ask_user_questions():
 	global_menu = archinstall.GlobalMenu(data_store=archinstall.arguments)
@@ -290,6 +353,8 @@ def perform_installation(mountpoint: Path):
 				locale_config=locale_config,
 				mkinitcpio=False
 		)
+		# in place before any package hooks rebuild the initramfs, so every build uses our hooks
+		shutil.copyfile(f"{SCRIPTDIR}/mkinitcpio.conf", "/mnt/archinstall/etc/mkinitcpio.conf")
 		# to generate a fstab directory holder. Avoids an error on exit and at the same time checks the procedure
 		target = Path(f"{mountpoint}/etc/fstab")
 		if not target.parent.exists():
@@ -299,47 +364,62 @@ def perform_installation(mountpoint: Path):
 		installation.activate_time_synchronization()
 		installation.setup_swap("zram")
 
+		# fetch the sddm theme in the background while pacman does its thing
+		download_pool = ThreadPoolExecutor(max_workers=1)
+		theme_zip = download_pool.submit(download, SDDM_THEME_URL)
+		download_pool.shutdown(wait=False)
+
+		# let pacman fetch packages in parallel for everything below
+		with open("/mnt/archinstall/etc/pacman.conf", 'r') as file:
+			pacman_conf = file.read()
+		for option in ('Color', 'VerbosePkgLists'):
+			pacman_conf = re.sub(rf'^#[ \t]*{option}[ \t]*$', option, pacman_conf, flags=re.MULTILINE)
+		pacman_conf, found = re.subn(r'^#?[ \t]*ParallelDownloads[ \t]*=.*$', 'ParallelDownloads = 10', pacman_conf, flags=re.MULTILINE)
+		if not found:
+			pacman_conf = re.sub(r'^\[options\][ \t]*$', '[options]\nParallelDownloads = 10', pacman_conf, count=1, flags=re.MULTILINE)
+		with open("/mnt/archinstall/etc/pacman.conf", 'w') as file:
+			file.write(pacman_conf)
+
 		# this aur is so chaotic omg
+		# the key and bootstrap packages are bundled with the iso by the build script
 		print("Installing Chaotic AUR")
+		for file in ('chaotic-keyring.pkg.tar.zst', 'chaotic-mirrorlist.pkg.tar.zst'):
+			shutil.copyfile(f"{SCRIPTDIR}/{file}", f"/mnt/archinstall/var/cache/pacman/pkg/{file}")
+		# not /tmp, arch-chroot mounts a fresh tmpfs over it
+		shutil.copyfile(f"{SCRIPTDIR}/chaotic-aur.asc", "/mnt/archinstall/root/chaotic-aur.asc")
 		installation.run_command("pacman-key --init")
-		installation.run_command("pacman-key --recv-key 3056513887B78AEB")
+		installation.run_command("pacman-key --add /root/chaotic-aur.asc")
+		os.remove("/mnt/archinstall/root/chaotic-aur.asc")
 		installation.run_command("pacman-key --lsign-key 3056513887B78AEB")
-		installation.run_command("pacman -U 'https://cdn-mirror.chaotic.cx/chaotic-aur/chaotic-keyring.pkg.tar.zst' --noconfirm")
-		installation.run_command("pacman -U 'https://cdn-mirror.chaotic.cx/chaotic-aur/chaotic-mirrorlist.pkg.tar.zst' --noconfirm")
+		installation.run_command("pacman -U /var/cache/pacman/pkg/chaotic-keyring.pkg.tar.zst /var/cache/pacman/pkg/chaotic-mirrorlist.pkg.tar.zst --noconfirm")
 		
-		with open("/mnt/archinstall/etc/pacman.conf", 'r') as file:
-			lines = file.readlines()
 		repo_entry = "\n[polaris]\nServer = https://polaris-linux-distro.github.io/pacman-repo/repo\nSigLevel = Optional TrustAll\n"
 		repo_entry2 = "\n[chaotic-aur]\nInclude = /etc/pacman.d/chaotic-mirrorlist\n"
-		lines.append(repo_entry)
-		lines.append(repo_entry2)
-		with open("/mnt/archinstall/etc/pacman.conf", 'w') as file:
-			file.writelines(lines)
+		with open("/mnt/archinstall/etc/pacman.conf", 'a') as file:
+			file.write(repo_entry + repo_entry2)
 
-		installation.run_command("pacman -Syyu zsh --noconfirm")
-		installation.run_command("pacman -Sy polo aic94xx-firmware ast-firmware wd719x-firmware upd72020x-fw xvkbd --noconfirm")
 		gpu_vendor = gpuvendorutil.get_gpu_vendor()
-		if gpu_vendor == "amd":
-			installation.add_additional_packages(amd_drivers)
-		elif gpu_vendor == "intel":
-			installation.add_additional_packages(intel_drivers)
-		elif gpu_vendor == "nvidia_beforeturing":
-			installation.add_additional_packages(nvidia_drivers)
-		elif gpu_vendor == "nvidia_turingplus":
-			installation.add_additional_packages(nvidia_newer_drivers)
-		elif gpu_vendor == "vmware":
-			installation.add_additional_packages(vmware_drivers)
-		
-		installation.add_additional_packages(packages)
-		shutil.copy(f"{SCRIPTDIR}/useradd", "/mnt/archinstall/etc/default/useradd")
-		with open("/mnt/archinstall/etc/skel/.zshrc", 'w') as file:
-			file.writelines("# hmm")
+		gpu_packages = gpu_drivers.get(gpu_vendor, ())
+
+		# one transaction for everything, so pacman only syncs and resolves once
+		install_packages = ' '.join(dict.fromkeys(packages + gpu_packages + extra_packages))
+		for attempt in range(3):
+			try:
+				SysCommand(f'/usr/bin/arch-chroot {installation.target} pacman -Syu --needed --noconfirm {install_packages}', peek_output=True)
+				break
+			except exceptions.SysCallError as err:
+				if attempt == 2:
+					raise
+				warn(f"Package installation failed ({err}), retrying")
+		# useradd, dconf defaults, sddm config and release files, packed by the build script
+		with tarfile.open(f"{SCRIPTDIR}/assets.tar") as assets:
+			assets.extractall("/mnt/archinstall/", filter='data')
+		write_file("/mnt/archinstall/etc/skel/.zshrc", "# hmm")
 
 		if timezone := archinstall.arguments.get('timezone', None):
 			installation.set_timezone(timezone)
 		if archinstall.accessibility_tools_in_use():
 			installation.enable_espeakup()
-		installation.activate_time_synchronization()
 
 		if (root_pw := archinstall.arguments.get('!root-password', None)) and len(root_pw):
 			installation.user_set_pw('root', root_pw)
@@ -347,21 +427,16 @@ def perform_installation(mountpoint: Path):
 			installation.create_users(users)
 
 		# i feel like such an idiot knowing this needed only one function to fix it. ughhhhh
-		os.mkdir("/mnt/archinstall/etc/dconf/db/local.d")
-		shutil.copy(f"{SCRIPTDIR}/00_defaults", "/mnt/archinstall/etc/dconf/db/local.d/00_defaults")
-		with open("/mnt/archinstall/etc/dconf/profile/user", "w+") as f:
-			f.write("""user-db:user
+		Path("/mnt/archinstall/etc/dconf/profile").mkdir(parents=True, exist_ok=True)
+		write_file("/mnt/archinstall/etc/dconf/profile/user", """user-db:user
 system-db:local""")
 			
-		with open("/mnt/archinstall/etc/sudoers", 'r') as file:
-			lines = file.readlines()
-		entry = "\n%wheel ALL=(ALL:ALL) ALL"
-		lines.append(entry)
-		with open("/mnt/archinstall/etc/sudoers", 'w') as file:
-			file.writelines(lines)
-
-		with open("/mnt/archinstall/etc/zsh/zshrc", 'w') as file:
-			file.writelines("""HISTFILE=~/.histfile
+		# drop-in instead of editing sudoers itself, sudo wants these read-only
+		write_file("/mnt/archinstall/etc/sudoers.d/99-wheel", "%wheel ALL=(ALL:ALL) ALL\n", mode=0o440)
+		# the mode above only applies when the file is newly created
+		os.chmod("/mnt/archinstall/etc/sudoers.d/99-wheel", 0o440)
+
+		write_file("/mnt/archinstall/etc/zsh/zshrc", """HISTFILE=~/.histfile
 HISTSIZE=1000
 SAVEHIST=1000
 bindkey -e
@@ -371,31 +446,16 @@ compinit
 precmd() {print -rP '(%F{blue}%n%f @ %F{blue}%m%f - %F{blue}%~%f)'}
 PROMPT='%F{green}>>%f '""")
 
-		# Download the zip file
-		url = 'https://gitlab.com/api/v4/projects/37107648/packages/generic/sddm-eucalyptus-drop/2.0.0/sddm-eucalyptus-drop-v2.0.0.zip'
-		subprocess.run(['wget', url])
-
-		# Unzip the file
-		with zipfile.ZipFile('sddm-eucalyptus-drop-v2.0.0.zip', 'r') as zip_ref:
+		# Unzip the theme downloaded earlier, waiting for it if it isn't done yet
+		with zipfile.ZipFile(theme_zip.result(timeout=900), 'r') as zip_ref:
 			zip_ref.extractall('/mnt/archinstall/usr/share/sddm/themes')
-
-		# Remove the zip file
-		os.remove('sddm-eucalyptus-drop-v2.0.0.zip')
-		shutil.copy(f"{SCRIPTDIR}/sddm.conf", "/mnt/archinstall/etc/sddm.conf")
-		shutil.copy(f"{SCRIPTDIR}/mkinitcpio.conf", "/mnt/archinstall/etc/mkinitcpio.conf")
-		shutil.copy(f"{SCRIPTDIR}/os-release", "/mnt/archinstall/etc/os-release")
-		shutil.copy(f"{SCRIPTDIR}/lsb-release", "/mnt/archinstall/etc/lsb-release")
 		
-		installation.run_command("chown -R root:root /etc/dconf/db")
-		installation.run_command("chmod -R 755 /etc/dconf/db")
-		installation.run_command("dconf update")
+		installation.run_command('sh -c "chown -R root:root /etc/dconf/db && chmod -R 755 /etc/dconf/db && dconf update"')
 		installation.run_command("plymouth-set-default-theme polaris")
 
-		installation.enable_service("sddm")
-		installation.enable_service("touchegg")
-		installation.enable_service("NetworkManager")
-		installation.enable_service("bluetooth")
+		installation.run_command("systemctl enable sddm touchegg NetworkManager bluetooth")
 		installation.genfstab()
+		# the plymouth theme is baked into the initramfs, so this has to come after setting it
 		installation.run_command("mkinitcpio -P")
 
 ask_user_questions()